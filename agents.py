@@ -1,6 +1,118 @@
-import json
+import hashlib
+import logging
+import math
+import multiprocessing
+import os
+import re
+import threading
+import time
+from collections import ChainMap
+import numpy as np
+import orjson
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from io import BytesIO
+from json_repair import repair_json
+from pydantic import ValidationError
 from pypdf import PdfReader
-from groq_client import call_llm
+from groq import BadRequestError
+from groq_client import (
+    AGENT1_MODEL,
+    AGENT2_MODEL,
+    AGENT3_MODEL,
+    CACHE_DIR,
+    cacheable_text,
+    call_llm,
+    failed_json_generation,
+)
+from schemas import NOT_SPECIFIED, ArticleExtraction, MaterialEntry, schema_skeleton
+
+logger = logging.getLogger(__name__)
+
+try:
+    import fitz  # PyMuPDF
+except ImportError:
+    fitz = None
+
+# Pages are spread evenly over the CPUs, but a worker task never holds more
+# than this many pages of text, which bounds peak memory on very long articles.
+PDF_MAX_PAGES_PER_TASK = 50
+# Below this many pages the process pool costs more than it saves.
+PDF_PARALLEL_MIN_PAGES = 40
+
+# MOF/COF keywords from the Agent 1 prompt. Agent 1 only asks the LLM when a
+# paper has between MOF_MIN_HITS_LLM and MOF_MIN_HITS_ACCEPT - 1 matches.
+MOF_RE = re.compile(
+    r"(?i)\b(MOFs?|metal[-– ]organic frameworks?|COFs?|covalent[-– ]organic frameworks?"
+    r"|coordination polymers?|organic zeolites?)\b"
+)
+MOF_MIN_HITS_LLM = 1
+MOF_MIN_HITS_ACCEPT = 3
+
+# Opening markdown code fence (with optional language tag) around LLM JSON.
+_FENCE_RE = re.compile(r"^```[a-zA-Z]*\n")
+
+# Section headings that start the parts of a paper Agent 2 needs: a short line,
+# optionally numbered, starting with a capitalised keyword and with no sentence
+# after it, so wrapped body lines of two-column PDFs ("results show that ...")
+# are not taken for headings.
+SECTION_HEADING_RE = re.compile(
+    r"(?m)^[ \t]*(?:\d+(?:\.\d+)*\.?[ \t]*)?"
+    r"(?=[A-Z])(?i:experimental|synthesis|materials and methods|characteri[sz]ation|results)"
+    r"\b[^.\n]{0,30}$"
+)
+# Characters kept from the start of the article (title, DOI, abstract) and
+# after each matched heading.
+SECTION_HEAD_CHARS = 1500
+SECTION_WINDOW_CHARS = 2000
+# Input budget for a single Agent 2 call. Longer inputs are split into
+# overlapping windows that are extracted concurrently and merged.
+AGENT2_MAX_INPUT_CHARS = 10000
+AGENT2_WINDOW_CHARS = 8000
+AGENT2_WINDOW_OVERLAP = 2000
+AGENT2_MAP_WORKERS = 8
+# Upper bound on windows per article (each may take up to AGENT2_MAX_RETRIES + 1
+# calls). Beyond it, windows spread evenly over the text are kept.
+AGENT2_MAX_WINDOWS = int(os.getenv("GENMOF_AGENT2_MAX_WINDOWS", "16"))
+
+# Agent 3 suitability weights, applied to the KPI vector
+# [water stability, scalability, 100 - complexity, surface area, thermal stability].
+SUITABILITY_WEIGHTS = np.array([0.25, 0.20, 0.20, 0.20, 0.15])
+
+# Agent 2 sections searched by summarize_mof_for_application, and the
+# (label, field) lines it may emit, in output order.
+SUMMARY_SECTIONS = (
+    "article_info",
+    "reactants",
+    "synthesis_conditions",
+    "thermal_properties",
+    "surface_properties",
+    "chemical_properties",
+    "structure",
+    "application",
+)
+SUMMARY_FIELDS = (
+    ("DOI", "doi"),
+    ("Metal node", "metal_node_name"),
+    ("Organic linker", "organic_linker_name"),
+    ("Synthesis temperature (°C)", "reaction_temperature_celsius"),
+    ("Synthesis time (s)", "reaction_time_seconds"),
+    ("Stepwise segmentation", "stepwise_segmentation"),
+    ("Surface area (m2/g, higher is better for adsorption)", "surface_area_m2_per_g"),
+    ("Thermal stability, breakdown temperature (°C)", "breakdown_temperature_celsius"),
+    ("pH stability min", "ph_range_min"),
+    ("pH stability max", "ph_range_max"),
+    ("Dimensionality", "dimensionality"),
+    ("Nanocrystalline", "nanocrystalline"),
+    ("Amorphous", "amorphous"),
+    ("Reported primary application", "application"),
+)
+
+# Agent 2 re-asks the model with the validation error at most this many times.
+AGENT2_MAX_RETRIES = 2
+
+# While streaming, the partial JSON is repaired and re-parsed every this many
+# characters.
+STREAM_PARSE_INTERVAL = 256
 
 
 # ---------------------------
@@ -11,6 +123,70 @@ def extract_text_from_pdf_filelike(file_obj) -> str:
     """
     Extracts all text from a PDF uploaded via Streamlit (file-like object).
     """
+    pdf_bytes = file_obj.getvalue() if hasattr(file_obj, "getvalue") else file_obj.read()
+    return extract_text_from_pdf_bytes(pdf_bytes)
+
+
+def extract_text_from_pdf_bytes(pdf_bytes: bytes) -> str:
+    """
+    Extracts all text from raw PDF bytes. When GENMOF_CACHE_DIR is set, the
+    result is stored under pdf_text/<sha256 of the PDF>.txt and reused.
+    """
+    if not CACHE_DIR:
+        return _extract_text(pdf_bytes)
+
+    digest = hashlib.sha256(pdf_bytes).hexdigest()
+    cache_dir = os.path.join(CACHE_DIR, "pdf_text")
+    path = os.path.join(cache_dir, f"{digest}.txt")
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read()
+    except OSError:
+        pass
+
+    text = _extract_text(pdf_bytes)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return text
+
+
+def _extract_text(pdf_bytes: bytes) -> str:
+    """
+    Uses PyMuPDF, spreading page ranges over worker processes for long
+    articles; falls back to pypdf if PyMuPDF is not installed.
+
+    Workers are spawned rather than forked: forking the multi-threaded
+    Streamlit server process can deadlock the child.
+    """
+    if fitz is None:
+        return _extract_text_pypdf(BytesIO(pdf_bytes))
+
+    cpus = os.cpu_count() or 1
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        page_count = doc.page_count
+        batch = min(PDF_MAX_PAGES_PER_TASK, max(1, math.ceil(page_count / cpus)))
+        if page_count < PDF_PARALLEL_MIN_PAGES or batch >= page_count:
+            return _page_range_text(doc, 0, page_count)
+
+    starts = range(0, page_count, batch)
+    stops = [min(s + batch, page_count) for s in starts]
+    with ProcessPoolExecutor(
+        max_workers=min(cpus, len(starts)),
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_pdf_worker,
+        initargs=(pdf_bytes,),
+    ) as pool:
+        return "".join(pool.map(_extract_page_range, starts, stops))
+
+
+def _extract_text_pypdf(file_obj) -> str:
     reader = PdfReader(file_obj)
     text = ""
     for page in reader.pages:
@@ -20,16 +196,97 @@ def extract_text_from_pdf_filelike(file_obj) -> str:
     return text
 
 
+def _page_range_text(doc, start: int, stop: int) -> str:
+    text = ""
+    for i in range(start, stop):
+        page_text = doc[i].get_text("text")
+        if page_text:
+            text += page_text + "\n"
+    return text
+
+
+# Opened once per worker process by _init_pdf_worker.
+_worker_doc = None
+
+
+def _init_pdf_worker(pdf_bytes: bytes) -> None:
+    global _worker_doc
+    _worker_doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+
+
+def _extract_page_range(start: int, stop: int) -> str:
+    return _page_range_text(_worker_doc, start, stop)
+
+
 # ---------------------------
-# Agent 1 – Detect MOF/COF paper
+# JSON helpers
 # ---------------------------
 
-def agent1_filter_and_detect(title: str, text_snippet: str) -> dict:
+def safe_loads(raw: str):
     """
-    Decide whether a paper is about MOF/COF synthesis and extract basic info.
+    Parse a JSON reply from the LLM. Markdown code fences are stripped and the
+    text is parsed with orjson; malformed output (trailing commas, smart
+    quotes, surrounding prose, truncation) goes through json_repair instead.
+    Raises ValueError if nothing can be recovered.
+    """
+    s = raw.strip()
+    if s.startswith("```"):
+        s = _FENCE_RE.sub("", s)
+        if s.endswith("```"):
+            s = s[:-3]
+
+    try:
+        return orjson.loads(s)
+    except orjson.JSONDecodeError as e:
+        error = e
+
+    repaired = repair_json(s, return_objects=True)
+    if repaired == "" or repaired is None:
+        raise ValueError(f"No JSON found in LLM response: {error}")
+    return repaired
+
+
+def is_json_object(raw: str) -> bool:
+    """
+    True if safe_loads recovers a JSON object from raw (cache validate hook).
     """
+    try:
+        return isinstance(safe_loads(raw), dict)
+    except ValueError:
+        return False
+
+
+# ---------------------------
+# Streaming helper
+# ---------------------------
+
+def collect_stream(chunks, on_partial=None) -> str:
+    """
+    Concatenate streamed completion deltas into the full response text.
+
+    If on_partial is given, the text received so far is repaired into a JSON
+    value every STREAM_PARSE_INTERVAL characters and passed to it, so callers
+    can show partial results while the model is still generating.
+    """
+    parts = []
+    size = 0
+    next_parse = STREAM_PARSE_INTERVAL
+    for delta in chunks:
+        parts.append(delta)
+        size += len(delta)
+        if on_partial is not None and size >= next_parse:
+            next_parse = size + STREAM_PARSE_INTERVAL
+            partial = repair_json("".join(parts), return_objects=True)
+            if partial:
+                on_partial(partial)
+    return "".join(parts)
 
-    system = """
+
+# ---------------------------
+# Agent 1 – Detect MOF/COF paper
+# ---------------------------
+
+AGENT1_SYSTEM = """
 You are an expert in metal-organic frameworks (MOFs) and covalent-organic frameworks (COFs).
 MOF/COF-related articles are likely to contain keywords like:
 MOF, metal-organic framework, COF, covalent organic framework, organic–inorganic framework,
@@ -48,98 +305,136 @@ Reply ONLY in this JSON format:
 }
 """
 
+
+def agent1_filter_and_detect(title: str, text_snippet: str) -> dict:
+    """
+    Decide whether a paper is about MOF/COF synthesis and extract basic info.
+
+    Clear cases are settled by counting MOF/COF keywords (no keyword: not a
+    MOF paper; MOF_MIN_HITS_ACCEPT or more: MOF paper); only papers in
+    between are sent to the LLM.
+    """
+    hits = len(MOF_RE.findall(f"{title}\n{text_snippet}"))
+    if hits < MOF_MIN_HITS_LLM or hits >= MOF_MIN_HITS_ACCEPT:
+        return {
+            "is_mof_paper": hits >= MOF_MIN_HITS_ACCEPT,
+            "mof_names": [],
+            "applications": [],
+            "reason": f"Keyword pre-filter: {hits} MOF/COF keyword match(es); LLM check skipped.",
+        }
+
     user = f"Title: {title}\n\nSnippet:\n{text_snippet[:3000]}"
 
     raw = call_llm(
         [
-            {"role": "system", "content": system},
+            {"role": "system", "content": AGENT1_SYSTEM},
             {"role": "user", "content": user},
-        ]
+        ],
+        model=AGENT1_MODEL,
+        semantic=True,
+        validate=is_json_object,
     )
 
-    try:
-        return json.loads(raw)
-    except Exception:
-        start = raw.find("{")
-        end = raw.rfind("}") + 1
-        return json.loads(raw[start:end])
+    result = safe_loads(raw)
+    if not isinstance(result, dict):
+        raise ValueError(f"Agent 1 returned no JSON object: {raw[:200]!r}")
+    return result
 
 
 # ---------------------------
-# Agent 2 – Extract detailed MOF/COF parameters
+# Helper – Select the article sections Agent 2 needs
 # ---------------------------
 
-def agent2_extract_parameters(full_text: str) -> list:
+def select_relevant_sections(text: str) -> list:
     """
-    Extracts detailed parameters from a COF/MOF synthesis article.
-    Each returned entry corresponds to ONE material in the article.
+    Return the article head plus a window after every Experimental /
+    Synthesis / Materials and methods / Characterization / Results heading,
+    in document order with overlapping windows merged. Returns [] if no such
+    heading is found.
     """
+    spans = [
+        (m.start(), m.start() + SECTION_WINDOW_CHARS)
+        for m in SECTION_HEADING_RE.finditer(text)
+    ]
+    if not spans:
+        return []
 
-    schema = """
-For EACH COF/MOF material described in the article, return one JSON object:
+    merged = [(0, SECTION_HEAD_CHARS)]
+    for start, end in spans:
+        if start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return [text[start:end] for start, end in merged]
 
-{
-  "article_info": {
-    "doi": "Article DOI or not_specified",
-    "title": "Article title",
-    "material_name": "Name of the COF/MOF material (e.g., N3-COF, MOF-801)"
-  },
 
-  "reactants": {
-    "organic_linker_name": "Chemical name of organic linker/ligand or not_specified",
-    "organic_linker_quantity_mg": 0,
-    "metal_node_name": "Chemical name of metal core/node or not_specified",
-    "metal_node_quantity_mg": 0,
-    "solvent_name": "Solvent name(s) or not_specified",
-    "solvent_quantity_ml": 0
-  },
+def split_windows(text: str) -> list:
+    """
+    Split text into AGENT2_WINDOW_CHARS windows overlapping by
+    AGENT2_WINDOW_OVERLAP, so a material described across a boundary is
+    still seen whole by at least one window.
+    """
+    step = AGENT2_WINDOW_CHARS - AGENT2_WINDOW_OVERLAP
+    return [
+        text[i : i + AGENT2_WINDOW_CHARS]
+        for i in range(0, max(len(text) - AGENT2_WINDOW_OVERLAP, 1), step)
+    ]
 
-  "synthesis_conditions": {
-    "reaction_time_seconds": 0,
-    "reaction_temperature_celsius": 0,
-    "stirring": "yes|no|not_specified",
-    "total_reaction_time_seconds": 0,
-    "stepwise_segmentation": 0,
-    "ratio_components": "Molar ratio (e.g., 1:1:2) or not_specified",
-    "annealing_time_seconds": 0,
-    "annealing_temperature_celsius": 0
-  },
 
-  "morphology": {
-    "pore_size_nm": 0,
-    "pore_width_nm": 0,
-    "pore_distribution_nm": "range in nm or not_specified"
-  },
+def _is_default(value) -> bool:
+    return value in (0, None, "", NOT_SPECIFIED)
 
-  "thermal_properties": {
-    "breakdown_temperature_celsius": 0
-  },
 
-  "surface_properties": {
-    "surface_area_m2_per_g": 0,
-    "functional_groups": "List of functional groups or not_specified"
-  },
+def material_key(name) -> str:
+    """
+    Normalised material name used to detect duplicates: stripped, case-folded.
+    """
+    return str(name).strip().lower() if name is not None else ""
 
-  "chemical_properties": {
-    "ph_range_min": 0,
-    "ph_range_max": 0
-  },
 
-  "structure": {
-    "nanocrystalline": "yes|no|not_specified",
-    "amorphous": "yes|no|not_specified",
-    "polar": "yes|no|not_specified",
-    "nonpolar": "yes|no|not_specified",
-    "dimensionality": "1D|2D|3D|not_specified"
-  },
+def merge_material_entries(entry_lists: list) -> list:
+    """
+    Merge Agent 2 results from several calls on the same article. Entries with
+    the same material name (case-insensitive) are combined field by field,
+    keeping the first non-default value. Entries without a material name are
+    never merged, since nothing says they describe the same material.
+    """
+    merged = {}
+    for entries in entry_lists:
+        for entry in entries:
+            name = material_key(entry.get("article_info", {}).get("material_name"))
+            if _is_default(name):
+                # Integer keys never collide with names; len grows on every insert.
+                name = len(merged)
+            if name not in merged:
+                merged[name] = entry
+                continue
+            target = merged[name]
+            for section, fields in entry.items():
+                if not isinstance(fields, dict):
+                    continue
+                target_fields = target.setdefault(section, {})
+                for key, value in fields.items():
+                    if _is_default(target_fields.get(key)) and not _is_default(value):
+                        target_fields[key] = value
+    return list(merged.values())
 
-  "application": {
-    "application": "Primary application or purpose (e.g., gas storage, catalysis, water harvesting)"
-  }
-}
-"""
 
-    system = f"""
+# ---------------------------
+# Agent 2 – Extract detailed MOF/COF parameters
+# ---------------------------
+
+# Static Agent 2 prompt. Kept at module level so the bytes sent to the API
+# never change between calls, which is what provider-side prefix caching keys on.
+# The per-material schema is rendered from the Pydantic model that validates
+# the response, so prompt and validation cannot drift apart.
+AGENT2_SCHEMA = (
+    "For EACH COF/MOF material described in the article, return one JSON object:\n\n"
+    + orjson.dumps(schema_skeleton(MaterialEntry), option=orjson.OPT_INDENT_2).decode()
+    + "\n"
+)
+
+AGENT2_SYSTEM = """
 You are an expert in COF/MOF chemistry and data extraction.
 
 Extract the following parameters from the article text.
@@ -156,27 +451,110 @@ RULES:
 - Follow units: mg, ml, seconds, nm, °C.
 - It is acceptable to approximate from the text if the value is clearly implied.
 
-Return ONLY a JSON array (list) of objects matching this schema.
+Return ONLY a JSON object of the form {"materials": [...]}, where the list holds
+one object per material matching this schema.
 
 Schema:
-{schema}
-"""
+""" + AGENT2_SCHEMA
 
-    user = f"Article text (possibly truncated):\n{full_text[:12000]}"
 
-    raw = call_llm(
-        [
-            {"role": "system", "content": system},
-            {"role": "user", "content": user},
-        ]
-    )
+def agent2_extract_parameters(full_text: str, on_truncated=None) -> list:
+    """
+    Extracts detailed parameters from a COF/MOF synthesis article.
+    Each returned entry corresponds to ONE material in the article.
 
+    Short articles are sent whole. Longer ones are cut down to their
+    experimental/synthesis/characterization/results sections (or kept whole
+    if no such heading is found). If that still exceeds
+    AGENT2_MAX_INPUT_CHARS, it is split into overlapping windows that are
+    extracted concurrently (map) and merged by material name (reduce). At
+    most AGENT2_MAX_WINDOWS windows, spread over the whole text, are
+    extracted; on_truncated(message) is called when some are left out. A
+    window that fails is logged and skipped so the others still count; the
+    error is raised only if every window fails.
+    """
+    if len(full_text) <= AGENT2_MAX_INPUT_CHARS:
+        return _agent2_extract_chunk(full_text)
+
+    sections = select_relevant_sections(full_text)
+    text = "\n[...]\n".join(sections) if sections else full_text
+    if len(text) <= AGENT2_MAX_INPUT_CHARS:
+        return _agent2_extract_chunk(text)
+
+    windows = split_windows(text)
+    if len(windows) > AGENT2_MAX_WINDOWS:
+        message = (
+            f"Article too long: extracting {AGENT2_MAX_WINDOWS} of {len(windows)} text "
+            "windows, spread over the whole article; some materials may be missed."
+        )
+        logger.warning(message)
+        if on_truncated is not None:
+            on_truncated(message)
+        step = (len(windows) - 1) / max(AGENT2_MAX_WINDOWS - 1, 1)
+        windows = [windows[round(k * step)] for k in range(AGENT2_MAX_WINDOWS)]
+
+    results = [None] * len(windows)
+    errors = []
+    with ThreadPoolExecutor(max_workers=min(AGENT2_MAP_WORKERS, len(windows))) as pool:
+        futures = {pool.submit(_agent2_extract_chunk, w): i for i, w in enumerate(windows)}
+        for fut in as_completed(futures):
+            i = futures[fut]
+            try:
+                results[i] = fut.result()
+            except Exception as e:
+                logger.warning("Agent 2 window %d/%d failed, skipping: %s", i + 1, len(windows), e)
+                errors.append(e)
+    if len(errors) == len(windows):
+        raise errors[0]
+    return merge_material_entries(r for r in results if r is not None)
+
+
+def _is_valid_extraction(raw: str) -> bool:
     try:
-        return json.loads(raw)
-    except Exception:
-        start = raw.find("[")
-        end = raw.rfind("]") + 1
-        return json.loads(raw[start:end])
+        ArticleExtraction.model_validate_json(raw)
+    except ValidationError:
+        return False
+    return True
+
+
+def _agent2_extract_chunk(text: str) -> list:
+    """
+    One Agent 2 call. The response is requested in JSON mode and validated
+    against ArticleExtraction. On a validation error, or when Groq rejects
+    the generation as invalid JSON (400 json_validate_failed), the model is
+    shown its output and the error and asked again (up to
+    AGENT2_MAX_RETRIES times).
+    """
+    user = f"Article text (excerpts):\n{text}"
+
+    messages = [
+        {"role": "system", "content": cacheable_text(AGENT2_SYSTEM)},
+        {"role": "user", "content": user},
+    ]
+
+    for attempt in range(AGENT2_MAX_RETRIES + 1):
+        try:
+            raw = call_llm(
+                messages,
+                model=AGENT2_MODEL,
+                response_format={"type": "json_object"},
+                validate=_is_valid_extraction,
+            )
+            extraction = ArticleExtraction.model_validate_json(raw)
+        except (ValidationError, BadRequestError) as e:
+            if isinstance(e, BadRequestError):
+                raw = failed_json_generation(e)
+                if raw is None:
+                    raise
+            if attempt == AGENT2_MAX_RETRIES:
+                raise
+            feedback = [{"role": "assistant", "content": raw}] if raw else []
+            messages = messages + feedback + [
+                {"role": "user", "content": f"Your output had error: {e}. Fix and retry."},
+            ]
+            time.sleep(attempt + 1)
+            continue
+        return [m.model_dump() for m in extraction.materials]
 
 
 # ---------------------------
@@ -186,116 +564,51 @@ Schema:
 def summarize_mof_for_application(mof_entry: dict) -> str:
     """
     Build a short natural-language summary of the MOF/COF from the extracted
-    parameter schema to help Agent 3 reason more accurately.
-    """
-    ai = mof_entry.get("article_info", {})
-    reac = mof_entry.get("reactants", {})
-    cond = mof_entry.get("synthesis_conditions", {})
-    morph = mof_entry.get("morphology", {})
-    therm = mof_entry.get("thermal_properties", {})
-    surf = mof_entry.get("surface_properties", {})
-    chem = mof_entry.get("chemical_properties", {})
-    struct = mof_entry.get("structure", {})
-    appl = mof_entry.get("application", {})
-
-    name = ai.get("material_name", "unnamed material")
-    doi = ai.get("doi", "not_specified")
-
-    linker = reac.get("organic_linker_name", "not_specified")
-    metal = reac.get("metal_node_name", "not_specified")
-
-    temp = cond.get("reaction_temperature_celsius", 0) or 0
-    time_s = cond.get("reaction_time_seconds", 0) or 0
-    steps = cond.get("stepwise_segmentation", 0) or 0
-
-    sa = surf.get("surface_area_m2_per_g", 0) or 0
-    tga = therm.get("breakdown_temperature_celsius", 0) or 0
-
-    ph_min = chem.get("ph_range_min", 0) or 0
-    ph_max = chem.get("ph_range_max", 0) or 0
-
-    dim = struct.get("dimensionality", "not_specified")
-    nano = struct.get("nanocrystalline", "not_specified")
-    amorph = struct.get("amorphous", "not_specified")
-
-    application = appl.get("application", "not_specified")
-
-    summary_lines = [
-        f"Material name: {name} (DOI: {doi}).",
-        f"Metal node: {metal}; organic linker: {linker}.",
-        f"Synthesis: temperature ~{temp} °C, time ~{time_s} s, stepwise segmentation = {steps}.",
-        f"Surface area: {sa} m2/g (higher is better for adsorption).",
-        f"Thermal stability (breakdown temperature): ~{tga} °C.",
-        f"Reported pH stability range: {ph_min}–{ph_max}.",
-        f"Structure: dimensionality = {dim}, nanocrystalline = {nano}, amorphous = {amorph}.",
-        f"Reported primary application: {application}.",
+    parameter schema to help Agent 3 reason more accurately. Fields that were
+    not reported (0 / "not_specified") are left out.
+    """
+    fields = ChainMap(
+        *(s for s in (mof_entry.get(name) for name in SUMMARY_SECTIONS) if isinstance(s, dict))
+    )
+    name = fields.get("material_name")
+    if _is_default(name):
+        name = "unnamed material"
+
+    lines = [f"Material name: {name}"]
+    lines += [
+        f"{label}: {fields[key]}"
+        for label, key in SUMMARY_FIELDS
+        if not _is_default(fields.get(key))
     ]
-
-    return " ".join(summary_lines)
+    return "\n".join(lines)
 
 
 # ---------------------------
 # Agent 3 – Application suitability prediction (single score)
 # ---------------------------
 
-def agent3_predict_applications(mof_entry: dict) -> dict:
-    """
-    Given a single MOF/COF entry from Agent 2 (full parameter schema),
-    infer likely application areas and assess overall suitability (0–100%)
-    in a structured, evidence-based way.
-    """
-    import re as _re
-
-    summary = summarize_mof_for_application(mof_entry)
-
-    system = """
+# Fully static, so it is sent as a single cacheable block (see AGENT2_SYSTEM).
+AGENT3_SYSTEM = """
 You are a senior MOF/COF applications expert.
 
 Target context:
 - We are particularly interested in **water treatment applications** (e.g., seawater, brine, wastewater),
-  but you only need to output ONE overall suitability score per application (no separate Red Sea score).
+  but suitability is assessed once per application (no separate Red Sea score).
 
 You will receive:
 1) A short natural-language summary of the material (synthesis, surface area, TGA, pH range, structure).
 2) The full machine-extracted JSON parameters from a COF/MOF article.
 
-First, internally estimate three key KPIs as percentages:
-- stability_in_water_percent (0–100; 0 = very unstable, 100 = highly stable in water/seawater)
-- synthetic_complexity_percent (0–100; 0 = very simple & mild synthesis, 100 = extremely complex/harsh)
-- scalability_percent (0–100; 0 = not scalable, 100 = highly scalable & industrially friendly)
-
-Use reaction temperature/time, number of steps, required conditions, TGA, pH range,
-and any reported stability data to guide these values.
-
-SCORING RULES (conceptual, must be followed):
-
-For each candidate application, compute an overall suitability score out of 100% using the weights:
-
-- Water stability:          25%
-- Scalability:              20%
-- Complexity (penalty):     20%
-- Surface area:             20%
-- Thermal stability (TGA):  15%
-
-Define:
+For each candidate application you will estimate five KPIs as percentages (0–100):
+- stability_in_water_percent (0 = very unstable, 100 = highly stable in water/seawater)
+- synthetic_complexity_percent (0 = very simple & mild synthesis, 100 = extremely complex/harsh)
+- scalability_percent (0 = not scalable, 100 = highly scalable & industrially friendly)
 - surface_area_percent = min(surface_area_m2_per_g / 1500 * 100, 100)
 - thermal_stability_percent = min(TGA_C / 500 * 100, 100)
 
-First estimate a raw composite score:
-- raw_score ≈
-    0.25 * stability_in_water_percent
-  + 0.20 * scalability_percent
-  + 0.20 * (100 - synthetic_complexity_percent)
-  + 0.20 * surface_area_percent
-  + 0.15 * thermal_stability_percent
-
-Then map it to the final reported suitability_score_percent as:
-- suitability_score_percent ≈ round(0.6 * raw_score + 20), clipped to [0, 100].
-
-This mapping is chosen so that:
-- clearly poor materials are usually below ~40%,
-- typical reasonable materials fall around 50–70%,
-- exceptional candidates can reach 80–95%.
+Use reaction temperature/time, number of steps, required conditions, TGA, pH range,
+and any reported stability data to guide these values. The overall suitability
+score is computed from these KPIs afterwards, so do not output it.
 
 Your tasks:
 
@@ -309,7 +622,6 @@ Your tasks:
    - other clearly motivated use
 
 2) For EACH scenario, evaluate:
-   - suitability_score_percent: overall suitability of this MOF/COF for that application (0–100).
    - synthetic_complexity_percent (0–100; lower is better),
    - scalability_percent (0–100),
    - stability_in_water_percent (0–100),
@@ -329,7 +641,6 @@ Reply ONLY in valid JSON with this structure:
     {
       "name": "short name of application",
       "category": "water_treatment | gas_storage | catalysis | other",
-      "suitability_score_percent": 0,
       "synthetic_complexity_percent": 0,
       "scalability_percent": 0,
       "stability_in_water_percent": 0,
@@ -349,42 +660,92 @@ Reply ONLY in valid JSON with this structure:
 Be conservative. If important data (e.g., water stability) is missing, mention this in 'limitations' and 'uncertainties'.
 """
 
+
+def score_application_candidates(candidates: list) -> list:
+    """
+    Set suitability_score_percent on each candidate from its five KPIs:
+    round(0.6 * weighted KPI sum + 20), clipped to [0, 100]. The mapping puts
+    clearly poor materials below ~40%, typical ones around 50–70% and
+    exceptional candidates at 80–95%.
+
+    KPIs are clipped to [0, 100] first. Candidates with a missing or
+    non-numeric KPI get None rather than a score; non-dict items are left as
+    the model returned them.
+    """
+    scored = [c for c in candidates if isinstance(c, dict)]
+    if not scored:
+        return candidates
+
+    def kpi(c: dict, key: str) -> float:
+        try:
+            return float(c[key])
+        except (KeyError, TypeError, ValueError):
+            return np.nan
+
+    kpis = np.clip(
+        np.array(
+            [
+                [
+                    kpi(c, "stability_in_water_percent"),
+                    kpi(c, "scalability_percent"),
+                    kpi(c, "synthetic_complexity_percent"),
+                    kpi(c, "surface_area_percent"),
+                    kpi(c, "thermal_stability_percent"),
+                ]
+                for c in scored
+            ]
+        ),
+        0,
+        100,
+    )
+    kpis[:, 2] = 100 - kpis[:, 2]  # complexity is a penalty
+    raw = kpis @ SUITABILITY_WEIGHTS
+    scores = np.clip(np.round(0.6 * raw + 20), 0, 100)
+
+    for c, score in zip(scored, scores):
+        c["suitability_score_percent"] = None if np.isnan(score) else int(score)
+    return candidates
+
+
+def agent3_predict_applications(mof_entry: dict, on_partial=None) -> dict:
+    """
+    Given a single MOF/COF entry from Agent 2 (full parameter schema),
+    infer likely application areas and assess overall suitability (0–100%)
+    in a structured, evidence-based way.
+    The response is streamed; on_partial receives the partial result.
+    """
+    summary = summarize_mof_for_application(mof_entry)
+
     user = (
         "COF/MOF summary:\n"
         f"{summary}\n\n"
         "Full parameter JSON from Agent 2:\n"
-        f"{json.dumps(mof_entry, indent=2)}"
+        f"{orjson.dumps(mof_entry, option=orjson.OPT_INDENT_2).decode()}"
     )
 
-    raw = call_llm(
+    chunks = call_llm(
         [
-            {"role": "system", "content": system},
+            {"role": "system", "content": cacheable_text(AGENT3_SYSTEM)},
             {"role": "user", "content": user},
-        ]
+        ],
+        model=AGENT3_MODEL,
+        stream=True,
+        validate=is_json_object,
     )
-
-    def try_parse(s: str):
-        s = s.strip()
-        if s.startswith("```"):
-            s = _re.sub(r"^```[a-zA-Z]*\n", "", s)
-            if s.endswith("```"):
-                s = s[:-3]
-        return json.loads(s)
+    raw = collect_stream(chunks, on_partial)
 
     try:
-        return try_parse(raw)
-    except Exception:
-        try:
-            m = _re.search(r"\{.*\}", raw, _re.S)
-            if m:
-                return try_parse(m.group(0))
-        except Exception as e2:
-            return {
-                "parse_error": f"Could not parse Agent 3 JSON: {e2}",
-                "raw_response": raw,
-            }
-
+        result = safe_loads(raw)
+        if not isinstance(result, dict):
+            raise ValueError("expected a JSON object")
+    except ValueError as e:
         return {
-            "parse_error": "No JSON object found in Agent 3 response.",
+            "parse_error": f"Could not parse Agent 3 JSON: {e}",
             "raw_response": raw,
         }
+
+    if isinstance(result.get("application_candidates"), list):
+        result["application_candidates"] = score_application_candidates(
+            result["application_candidates"]
+        )
+    return result
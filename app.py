@@ -1,13 +1,28 @@
+import logging
+import re
 import streamlit as st
 import pandas as pd
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from io import BytesIO
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 from agents import (
-    extract_text_from_pdf_filelike,
+    extract_text_from_pdf_bytes,
     agent1_filter_and_detect,
     agent2_extract_parameters,
     agent3_predict_applications,
+    material_key,
 )
+from schemas import NOT_SPECIFIED
+
+# Print cache_hit / network_call / 429_retry events from groq_client.
+logging.basicConfig(format="%(asctime)s %(name)s %(levelname)s %(message)s")
+logging.getLogger("groq_client").setLevel(logging.INFO)
+
+# Groq calls are I/O-bound; the shared rate limiter in groq_client keeps
+# concurrent requests within the per-minute quota.
+MAX_WORKERS = 8
 
 st.set_page_config(page_title="GenMOF – Groq-powered MOF App", layout="wide")
 
@@ -30,143 +45,333 @@ uploaded_files = st.file_uploader(
     "Upload COF/MOF PDF articles", type=["pdf"], accept_multiple_files=True
 )
 
-if st.button("🚀 Run Pipeline") and uploaded_files:
-    for file in uploaded_files:
-        st.divider()
-        st.subheader(f"📄 {file.name}")
+@st.cache_data(max_entries=128, show_spinner=False)
+def load_pdf_text(pdf_bytes: bytes) -> str:
+    """
+    Session-level memo of PDF text, keyed by the PDF content, so re-runs and
+    re-uploads of the same file skip parsing.
+    """
+    return extract_text_from_pdf_bytes(pdf_bytes)
 
-        # 1) Extract full text
-        with st.spinner("Extracting PDF text..."):
-            text = extract_text_from_pdf_filelike(file)
 
-        article_word_count = len(text.split())
-        snippet = text[:2000]
+# ---------------------------
+# Excel export
+# ---------------------------
 
-        # 2) Agent 1 – MOF/COF detection
-        with st.spinner("Agent 1: Detecting if this is a MOF/COF synthesis paper..."):
-            a1 = agent1_filter_and_detect(file.name, snippet)
+def _excel_value(v):
+    if isinstance(v, (list, dict)):
+        return str(v)
+    if pd.isna(v):
+        return None
+    return v.item() if hasattr(v, "item") else v
 
-        a1["article_word_count"] = article_word_count
 
-        st.markdown("### 🔍 Agent 1 – MOF/COF Detection")
-        st.json(a1)
+def _write_sheet(writer, df: pd.DataFrame, sheet_name: str) -> None:
+    """
+    Write df strictly row by row. In constant_memory mode xlsxwriter flushes
+    a row as soon as the next one is started, and DataFrame.to_excel writes
+    column by column, so it cannot be used here.
+    """
+    worksheet = writer.book.add_worksheet(sheet_name)
+    worksheet.write_row(0, 0, [str(c) for c in df.columns])
+    for r, row in enumerate(df.itertuples(index=False), start=1):
+        worksheet.write_row(r, 0, [_excel_value(v) for v in row])
 
-        if not a1.get("is_mof_paper", False):
-            st.warning("❌ Not identified as a MOF/COF synthesis paper. Skipping further analysis.")
-            continue
 
-        # 3) Agent 2 – Detailed parameter extraction
-        with st.spinner("Agent 2: Extracting detailed material parameters..."):
-            entries = agent2_extract_parameters(text)
+def excel_bytes(sheets: dict) -> bytes:
+    """
+    Build an .xlsx workbook from {sheet_name: DataFrame}, streaming rows to
+    disk (xlsxwriter constant_memory) instead of holding the workbook in memory.
+    """
+    output = BytesIO()
+    with pd.ExcelWriter(
+        output, engine="xlsxwriter", engine_kwargs={"options": {"constant_memory": True}}
+    ) as writer:
+        for sheet_name, df in sheets.items():
+            _write_sheet(writer, df, sheet_name)
+    return output.getvalue()
+
+
+def sheet_name_for(file_name: str, taken: set) -> str:
+    """
+    Unique sheet name for a paper: at most 31 characters, without []:*?/\\
+    """
+    base = re.sub(r"[\[\]:*?/\\]", "_", file_name.replace(".pdf", ""))[:31] or "Sheet"
+    name, n = base, 1
+    while name.lower() in taken:
+        n += 1
+        suffix = f"_{n}"
+        name = base[: 31 - len(suffix)] + suffix
+    taken.add(name.lower())
+    return name
+
+
+# ---------------------------
+# Rendering helpers (main thread only)
+# ---------------------------
+
+def render_agent1(a1: dict) -> None:
+    st.markdown("### 🔍 Agent 1 – MOF/COF Detection")
+    st.json(a1)
+
+
+def _join_unique(values: pd.Series) -> str:
+    distinct = set(map(str, values.dropna())) - {"", NOT_SPECIFIED}
+    return " / ".join(sorted(distinct)) or NOT_SPECIFIED
+
+
+def merge_duplicate_materials(df: pd.DataFrame, entries: list):
+    """
+    Collapse rows that share a material name (e.g. several synthesis trials in
+    one paper), compared with material_key like agents.merge_material_entries:
+    numeric columns keep their max, other columns join their distinct values
+    with " / " (ignoring not_specified), and the name keeps its first spelling.
+    For each material, the entry with the largest surface area is kept as its
+    representative for Agent 3. Rows without a material name are kept as they
+    are.
+    """
+    key = "article_info_material_name"
+    if key not in df.columns:
+        return df, entries
+    groups = df[key].map(material_key)
+    # Unnamed rows get their (integer) row label, which no name can collide with.
+    groups = groups.where(~groups.isin(["", NOT_SPECIFIED]), df.index.to_series())
+    if not groups.duplicated().any():
+        return df, entries
+
+    surf_col = "surface_properties_surface_area_m2_per_g"
+    if surf_col in df.columns:
+        surf = pd.to_numeric(df[surf_col], errors="coerce").fillna(0)
+    else:
+        surf = pd.Series(0, index=df.index)
+    representatives = surf.groupby(groups, sort=False).idxmax()
+
+    agg_map = {
+        c: "max" if pd.api.types.is_numeric_dtype(df[c]) else _join_unique
+        for c in df.columns
+        if c != key
+    }
+    agg_map[key] = "first"
+    merged = df.groupby(groups, sort=False).agg(agg_map).reset_index(drop=True)
+    return merged[df.columns], [entries[i] for i in representatives]
+
+
+def render_agent2(file_name: str, entries: list):
+    """
+    Show Agent 2 results and the Excel download. Returns (parameter DataFrame,
+    one entry per unique material for Agent 3), or (None, []) if nothing was
+    extracted.
+    """
+    st.markdown("### ⚗️ Agent 2 – Full Extracted Parameter Set (per material)")
+    st.json(entries)
 
-        st.markdown("### ⚗️ Agent 2 – Full Extracted Parameter Set (per material)")
-        st.json(entries)
+    if not entries:
+        st.warning("No COF/MOF materials extracted by Agent 2.")
+        return None, []
 
-        if not entries:
-            st.warning("No COF/MOF materials extracted by Agent 2.")
+    # ------- Flatten entries into a DataFrame -------
+    df = pd.json_normalize(entries, sep="_")
+    df, entries = merge_duplicate_materials(df, entries)
+
+    # Pretty column names
+    rename_map = {
+        "article_info_doi": "DOI",
+        "article_info_title": "Title",
+        "article_info_material_name": "Material",
+        "reactants_organic_linker_name": "Organic linker",
+        "reactants_metal_node_name": "Metal node",
+        "synthesis_conditions_reaction_temperature_celsius": "Reaction temp (°C)",
+        "synthesis_conditions_reaction_time_seconds": "Reaction time (s)",
+        "surface_properties_surface_area_m2_per_g": "Surface area (m2/g)",
+        "thermal_properties_breakdown_temperature_celsius": "TGA breakdown (°C)",
+        "chemical_properties_ph_range_min": "pH min",
+        "chemical_properties_ph_range_max": "pH max",
+        "application_application": "Application",
+    }
+    df.rename(columns=rename_map, inplace=True)
+
+    must_have_cols = [
+        "DOI",
+        "Title",
+        "Material",
+        "Organic linker",
+        "Metal node",
+        "Reaction temp (°C)",
+        "Reaction time (s)",
+        "Surface area (m2/g)",
+        "TGA breakdown (°C)",
+        "Application",
+    ]
+    display_cols = [c for c in must_have_cols if c in df.columns]
+
+    st.markdown("#### ⭐ Key Parameters (must-have subset)")
+    if display_cols:
+        st.dataframe(df[display_cols])
+    else:
+        st.info("Key parameters not available for this article; showing full JSON above.")
+
+    # ------- Excel download with ALL parameters -------
+    excel_data = excel_bytes({"COF_MOF_parameters": df})
+
+    st.download_button(
+        label="💾 Download all parameters as Excel",
+        data=excel_data,
+        file_name=f"cof_mof_parameters_{file_name.replace('.pdf','')}.xlsx",
+        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    )
+
+    return df, entries
+
+
+def render_agent3(app_predictions: dict, material_name: str) -> None:
+    st.markdown(f"### 🔮 Agent 3 – Predicted Applications & Suitability: {material_name}")
+    st.json(app_predictions)
+
+    # Compact scoring table (overall suitability only)
+    if isinstance(app_predictions, dict) and "application_candidates" in app_predictions:
+        try:
+            apps_df = pd.json_normalize(app_predictions["application_candidates"])
+            if not apps_df.empty:
+                cols = [
+                    "name",
+                    "category",
+                    "suitability_score_percent",
+                ]
+                cols = [c for c in cols if c in apps_df.columns]
+                if cols:
+                    apps_df = apps_df[cols]
+                    pretty_cols = {
+                        "name": "Application",
+                        "category": "Category",
+                        "suitability_score_percent": "Suitability (%)",
+                    }
+                    apps_df.rename(columns=pretty_cols, inplace=True)
+
+                    st.markdown("#### 📊 Application scoring overview")
+                    st.dataframe(apps_df)
+        except Exception:
+            pass
+
+
+def run_stage(executor, panels, jobs, label):
+    """
+    Submit one pipeline stage for every paper at once and yield
+    (index, result) as the calls complete. Failed papers are marked as errors
+    in their status panel and dropped from later stages.
+
+    jobs: {key: (fn, *args)}; panels: {key: status panel of that job}
+    """
+    futures = {}
+    for key, (fn, *args) in jobs.items():
+        panels[key].update(label=f"{label}...", state="running")
+        futures[executor.submit(fn, *args)] = key
+
+    for future in as_completed(futures):
+        key = futures[future]
+        try:
+            result = future.result()
+        except Exception as e:
+            with panels[key]:
+                st.error(f"{label} failed: {e}")
+            panels[key].update(label=f"{label} failed", state="error")
             continue
+        yield key, result
+
 
-        # ------- Flatten entries into a DataFrame -------
-        def flatten_entry(entry: dict) -> dict:
-            flat = {}
-            for section_name, section_value in entry.items():
-                if isinstance(section_value, dict):
-                    for k, v in section_value.items():
-                        flat[f"{section_name}_{k}"] = v
-                else:
-                    flat[section_name] = section_value
-            return flat
-
-        flat_entries = [flatten_entry(e) for e in entries]
-        df = pd.DataFrame(flat_entries)
-
-        # Pretty column names
-        rename_map = {
-            "article_info_doi": "DOI",
-            "article_info_title": "Title",
-            "article_info_material_name": "Material",
-            "reactants_organic_linker_name": "Organic linker",
-            "reactants_metal_node_name": "Metal node",
-            "synthesis_conditions_reaction_temperature_celsius": "Reaction temp (°C)",
-            "synthesis_conditions_reaction_time_seconds": "Reaction time (s)",
-            "surface_properties_surface_area_m2_per_g": "Surface area (m2/g)",
-            "thermal_properties_breakdown_temperature_celsius": "TGA breakdown (°C)",
-            "chemical_properties_ph_range_min": "pH min",
-            "chemical_properties_ph_range_max": "pH max",
-            "application_application": "Application",
+# ---------------------------
+# Pipeline
+# ---------------------------
+
+if st.button("🚀 Run Pipeline") and uploaded_files:
+    # One status panel per paper, in upload order. All papers go through each
+    # agent concurrently; results are written into their panel as they arrive.
+    panels = {}
+    for i, file in enumerate(uploaded_files):
+        st.divider()
+        st.subheader(f"📄 {file.name}")
+        panels[i] = st.status("Queued", expanded=True)
+
+    # Workers get the script context so streamed partial results can be
+    # written into their placeholders while a call is still running.
+    with ThreadPoolExecutor(
+        max_workers=MAX_WORKERS,
+        initializer=add_script_run_ctx,
+        initargs=(None, get_script_run_ctx()),
+    ) as executor:
+        # 1) Extract full text (an unreadable PDF only drops that paper)
+        extract_jobs = {
+            i: (load_pdf_text, file.getvalue()) for i, file in enumerate(uploaded_files)
+        }
+        texts = dict(run_stage(executor, panels, extract_jobs, "Extracting PDF text"))
+
+        # 2) Agent 1 – MOF/COF detection
+        agent1_jobs = {
+            i: (agent1_filter_and_detect, uploaded_files[i].name, text[:2000])
+            for i, text in texts.items()
         }
-        df.rename(columns=rename_map, inplace=True)
-
-        must_have_cols = [
-            "DOI",
-            "Title",
-            "Material",
-            "Organic linker",
-            "Metal node",
-            "Reaction temp (°C)",
-            "Reaction time (s)",
-            "Surface area (m2/g)",
-            "TGA breakdown (°C)",
-            "Application",
-        ]
-        display_cols = [c for c in must_have_cols if c in df.columns]
-
-        st.markdown("#### ⭐ Key Parameters (must-have subset)")
-        if display_cols:
-            st.dataframe(df[display_cols])
-        else:
-            st.info("Key parameters not available for this article; showing full JSON above.")
-
-        # ------- Excel download with ALL parameters -------
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine="openpyxl") as writer:
-            df.to_excel(writer, index=False, sheet_name="COF_MOF_parameters")
-        excel_data = output.getvalue()
+        mof_papers = []
+        for i, a1 in run_stage(
+            executor, panels, agent1_jobs, "Agent 1: Detecting if this is a MOF/COF synthesis paper"
+        ):
+            a1["article_word_count"] = len(texts[i].split())
+            with panels[i]:
+                render_agent1(a1)
+                if not a1.get("is_mof_paper", False):
+                    st.warning("❌ Not identified as a MOF/COF synthesis paper. Skipping further analysis.")
+            if a1.get("is_mof_paper", False):
+                mof_papers.append(i)
+            else:
+                panels[i].update(label="Not a MOF/COF synthesis paper", state="complete")
 
+        # 3) Agent 2 – Detailed parameter extraction
+        agent2_jobs = {
+            i: (agent2_extract_parameters, texts[i], panels[i].warning) for i in mof_papers
+        }
+        materials = {}
+        parameter_frames = {}
+        for i, entries in run_stage(
+            executor, panels, agent2_jobs, "Agent 2: Extracting detailed material parameters"
+        ):
+            with panels[i]:
+                df, unique_entries = render_agent2(uploaded_files[i].name, entries)
+            if not unique_entries:
+                panels[i].update(label="No COF/MOF materials extracted", state="complete")
+            else:
+                for j, entry in enumerate(unique_entries):
+                    materials[(i, j)] = entry
+                parameter_frames[i] = df
+
+        # 4) Agent 3 – Application prediction & suitability, per unique material
+        material_panels = {key: panels[key[0]] for key in materials}
+        previews = {key: material_panels[key].empty() for key in materials}
+        agent3_jobs = {
+            key: (agent3_predict_applications, entry, previews[key].json)
+            for key, entry in materials.items()
+        }
+        remaining = Counter(i for i, _ in materials)
+        for key, app_predictions in run_stage(
+            executor, material_panels, agent3_jobs, "Agent 3: Predicting applications & suitability"
+        ):
+            i = key[0]
+            name = materials[key].get("article_info", {}).get("material_name", "unnamed material")
+            previews[key].empty()
+            with panels[i]:
+                render_agent3(app_predictions, name)
+            remaining[i] -= 1
+            if remaining[i] == 0:
+                panels[i].update(label="Done", state="complete")
+
+    # One workbook for the whole run, one sheet per paper.
+    if len(parameter_frames) > 1:
+        st.divider()
+        taken = set()
+        sheets = {
+            sheet_name_for(uploaded_files[i].name, taken): parameter_frames[i]
+            for i in sorted(parameter_frames)
+        }
         st.download_button(
-            label="💾 Download all parameters as Excel",
-            data=excel_data,
-            file_name=f"cof_mof_parameters_{file.name.replace('.pdf','')}.xlsx",
+            label="💾 Download parameters of all papers as one Excel workbook",
+            data=excel_bytes(sheets),
+            file_name="cof_mof_parameters_all.xlsx",
             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
         )
-
-        # ------- Choose a "best" material for Agent 3 -------
-        best_index = 0
-        if "Surface area (m2/g)" in df.columns:
-            surf = pd.to_numeric(df["Surface area (m2/g)"], errors="coerce").fillna(0)
-            if not surf.empty:
-                best_index = int(surf.idxmax())
-
-        best_entry = entries[best_index]
-
-        # 4) Agent 3 – Application prediction & suitability
-        with st.spinner("Agent 3: Predicting applications & suitability..."):
-            app_predictions = agent3_predict_applications(best_entry)
-
-        st.markdown("### 🔮 Agent 3 – Predicted Applications & Suitability")
-        st.json(app_predictions)
-
-        # Compact scoring table (overall suitability only)
-        if isinstance(app_predictions, dict) and "application_candidates" in app_predictions:
-            try:
-                apps_df = pd.DataFrame(app_predictions["application_candidates"])
-                if not apps_df.empty:
-                    cols = [
-                        "name",
-                        "category",
-                        "suitability_score_percent",
-                    ]
-                    cols = [c for c in cols if c in apps_df.columns]
-                    if cols:
-                        apps_df = apps_df[cols]
-                        pretty_cols = {
-                            "name": "Application",
-                            "category": "Category",
-                            "suitability_score_percent": "Suitability (%)",
-                        }
-                        apps_df.rename(columns=pretty_cols, inplace=True)
-
-                        st.markdown("#### 📊 Application scoring overview")
-                        st.dataframe(apps_df)
-            except Exception:
-                pass
@@ -1,24 +1,419 @@
+import functools
+import hashlib
+import logging
 import os
-from groq import Groq
+import threading
+import time
+import orjson
+from groq import APIConnectionError, APIStatusError, BadRequestError, Groq, RateLimitError
 from dotenv import load_dotenv
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
 
 # Load environment variables from .env
 load_dotenv()
 
-client = Groq(api_key=os.getenv("GROQ_API_KEY"))
+logger = logging.getLogger(__name__)
+
+# Retries (429, connection errors, 408/409/5xx) are handled by _create with
+# backoff and logging, not by the SDK.
+client = Groq(api_key=os.getenv("GROQ_API_KEY"), max_retries=0)
 
 DEFAULT_MODEL = "llama-3.3-70b-versatile"
 
+# Agent 1 is a yes/no classification plus a few names, so it runs on the
+# small, fast model; extraction and application reasoning keep the 70B.
+AGENT1_MODEL = "llama-3.1-8b-instant"
+AGENT2_MODEL = DEFAULT_MODEL
+AGENT3_MODEL = DEFAULT_MODEL
+
+# Directory for the on-disk response cache. Leave unset to disable caching.
+CACHE_DIR = os.getenv("GENMOF_CACHE_DIR")
+
+# SQLite file for the semantic (near-duplicate) response cache. Leave unset to
+# disable it; it also needs the optional fastembed and faiss-cpu packages.
+SEMANTIC_CACHE_PATH = os.getenv("GENMOF_SEMANTIC_CACHE")
+SEMANTIC_CACHE_THRESHOLD = 0.92
+# Above this temperature responses are meant to vary, so they are never reused.
+SEMANTIC_CACHE_MAX_TEMPERATURE = 0.2
+
+# Groq free tier allows 30 requests per minute; shared by all worker threads.
+RATE_LIMIT_PER_MINUTE = int(os.getenv("GROQ_RATE_LIMIT_PER_MINUTE", "30"))
+
+# Flipped off the first time the API rejects structured content blocks.
+_content_blocks_supported = True
+
+
+# ---------------------------
+# Rate limiting
+# ---------------------------
+
+class _TokenBucket:
+    """
+    Thread-safe token bucket: holds up to `rate_per_minute` tokens, refilled
+    continuously. acquire() blocks until a token is available.
+    """
+
+    def __init__(self, rate_per_minute: int):
+        self.capacity = float(rate_per_minute)
+        self.tokens = float(rate_per_minute)
+        self.fill_rate = rate_per_minute / 60.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.fill_rate
+            time.sleep(wait)
+
+
+_rate_limiter = _TokenBucket(RATE_LIMIT_PER_MINUTE)
+
+
+# ---------------------------
+# Prompt-prefix caching
+# ---------------------------
+
+def cacheable_text(text: str) -> list:
+    """
+    Wrap static prompt text as a content block marked for provider-side
+    prefix caching ("cache_control": ephemeral).
+    """
+    return [{"type": "text", "text": text, "cache_control": {"type": "ephemeral"}}]
+
+
+def _has_content_blocks(messages) -> bool:
+    return any(isinstance(m.get("content"), list) for m in messages)
+
+
+def _error_code(e: BadRequestError):
+    body = e.body if isinstance(e.body, dict) else {}
+    error = body.get("error", body)
+    return error.get("code") if isinstance(error, dict) else None
+
+
+def failed_json_generation(e: BadRequestError):
+    """
+    For a JSON-mode json_validate_failed 400, return the model's rejected
+    output ("" if the API did not include it); None for any other 400.
+    """
+    if _error_code(e) != "json_validate_failed":
+        return None
+    body = e.body if isinstance(e.body, dict) else {}
+    error = body.get("error", body)
+    failed = error.get("failed_generation") if isinstance(error, dict) else None
+    return failed if isinstance(failed, str) else ""
+
+
+def _is_content_shape_error(e: BadRequestError) -> bool:
+    """
+    True if a 400 rejects the structured content / cache_control shape itself,
+    as opposed to e.g. context length or JSON-mode generation failures.
+    """
+    if _error_code(e) == "json_validate_failed":
+        return False
+    message = str(e).lower()
+    return "cache_control" in message or ".content" in message or "content must be" in message
+
+
+def _flatten_content(messages) -> list:
+    """
+    Collapse structured content blocks back into plain strings for APIs
+    that only accept string content.
+    """
+    flat = []
+    for m in messages:
+        content = m.get("content")
+        if isinstance(content, list):
+            content = "".join(b.get("text", "") for b in content if b.get("type") == "text")
+        flat.append({**m, "content": content})
+    return flat
+
+
+# ---------------------------
+# On-disk response cache
+# ---------------------------
+
+def _cache_key(messages, model: str, temperature: float, response_format=None) -> str:
+    """
+    SHA-256 over (model, temperature, response_format, messages). Every part is
+    prefixed with its 8-byte length so that different splits of the same bytes
+    never collide.
+    """
+    parts = [
+        model.encode("utf-8"),
+        repr(float(temperature)).encode("utf-8"),
+        orjson.dumps(response_format, option=orjson.OPT_SORT_KEYS),
+    ]
+    parts += [orjson.dumps(m, option=orjson.OPT_SORT_KEYS) for m in messages]
+
+    h = hashlib.sha256()
+    for data in parts:
+        h.update(len(data).to_bytes(8, "big"))
+        h.update(data)
+    return h.hexdigest()
+
+
+def _cache_read(path: str, key: str):
+    """
+    Return the cached completion text, or None if missing or invalid.
+    """
+    try:
+        with open(path, "rb") as f:
+            record = orjson.loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+    if not isinstance(record, dict) or record.get("key") != key:
+        return None
+    content = record.get("content")
+    return content if isinstance(content, str) else None
+
+
+def _cache_write(path: str, key: str, model: str, content: str) -> None:
+    # Unique per thread: concurrent pipeline workers may write the same key.
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(orjson.dumps({"key": key, "model": model, "content": content}))
+        os.replace(tmp_path, path)
+    except OSError:
+        # A failed cache write must never break the pipeline.
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _cached_result(content: str, stream: bool):
+    return iter([content]) if stream else content
+
 
-def call_llm(messages, model: str = DEFAULT_MODEL, temperature: float = 0.2) -> str:
+def _store_when_done(content, store, validate=None):
+    """
+    Pass the full completion text to store(): right away for a plain string,
+    or once the caller has consumed a streamed response to the end. If a
+    validate(text) callback is given, only replies it accepts are stored.
+    """
+    def store_if_valid(text: str) -> None:
+        if validate is not None:
+            try:
+                if not validate(text):
+                    return
+            except Exception:
+                return
+        store(text)
+
+    if isinstance(content, str):
+        store_if_valid(content)
+        return content
+    return _stream_then_store(content, store_if_valid)
+
+
+def _stream_then_store(chunks, store):
+    parts = []
+    for delta in chunks:
+        parts.append(delta)
+        yield delta
+    store("".join(parts))
+
+
+def _disk_cached(func):
+    """
+    Short-circuit identical requests with completions stored as plain JSON
+    under CACHE_DIR/<sha256>.json. No-op when GENMOF_CACHE_DIR is unset.
+    """
+
+    @functools.wraps(func)
+    def wrapper(messages, model: str = DEFAULT_MODEL, temperature: float = 0.2, **kwargs):
+        if not CACHE_DIR:
+            return func(messages, model=model, temperature=temperature, **kwargs)
+
+        key = _cache_key(messages, model, temperature, kwargs.get("response_format"))
+        path = os.path.join(CACHE_DIR, f"{key}.json")
+
+        cached = _cache_read(path, key)
+        if cached is not None:
+            logger.info("cache_hit: disk %s", key[:12])
+            return _cached_result(cached, kwargs.get("stream", False))
+
+        def store(content: str) -> None:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            _cache_write(path, key, model, content)
+
+        content = func(messages, model=model, temperature=temperature, **kwargs)
+        return _store_when_done(content, store, kwargs.get("validate"))
+
+    return wrapper
+
+
+# ---------------------------
+# Semantic response cache
+# ---------------------------
+
+_semantic_cache = None
+_semantic_cache_lock = threading.Lock()
+
+
+def _get_semantic_cache():
+    """
+    Lazily build the process-wide SemanticCache. Returns None (and stays
+    disabled) when GENMOF_SEMANTIC_CACHE is unset, its packages are missing or
+    it cannot be opened.
+    """
+    global _semantic_cache, SEMANTIC_CACHE_PATH
+
+    if not SEMANTIC_CACHE_PATH:
+        return None
+    with _semantic_cache_lock:
+        if _semantic_cache is None:
+            try:
+                from semantic_cache import SemanticCache
+
+                _semantic_cache = SemanticCache(
+                    SEMANTIC_CACHE_PATH, threshold=SEMANTIC_CACHE_THRESHOLD
+                )
+            except Exception:
+                logger.warning(
+                    "Semantic cache disabled: could not open %s",
+                    SEMANTIC_CACHE_PATH,
+                    exc_info=True,
+                )
+                SEMANTIC_CACHE_PATH = None
+                return None
+    return _semantic_cache
+
+
+def _semantic_cached(func):
+    """
+    For calls made with semantic=True, reuse the response of a cosine-similar
+    earlier prompt (same model and system prompt) instead of calling the API.
+    Only the last message is embedded.
+    """
+
+    @functools.wraps(func)
+    def wrapper(
+        messages,
+        model: str = DEFAULT_MODEL,
+        temperature: float = 0.2,
+        semantic: bool = False,
+        **kwargs,
+    ):
+        cache = None
+        if semantic and temperature <= SEMANTIC_CACHE_MAX_TEMPERATURE:
+            cache = _get_semantic_cache()
+        if cache is None:
+            return func(messages, model=model, temperature=temperature, **kwargs)
+
+        namespace = _cache_key(messages[:-1], model, temperature, kwargs.get("response_format"))
+        text = _flatten_content(messages[-1:])[0]["content"]
+
+        cached = cache.get(namespace, text)
+        if cached is not None:
+            logger.info("cache_hit: semantic %s", namespace[:12])
+            return _cached_result(cached, kwargs.get("stream", False))
+
+        content = func(messages, model=model, temperature=temperature, **kwargs)
+        return _store_when_done(
+            content, lambda c: cache.put(namespace, text, c), kwargs.get("validate")
+        )
+
+    return wrapper
+
+
+@_disk_cached
+@_semantic_cached
+def call_llm(
+    messages,
+    model: str = DEFAULT_MODEL,
+    temperature: float = 0.2,
+    stream: bool = False,
+    response_format: dict = None,
+    validate=None,
+):
     """
     Simple wrapper around the Groq chat completion API.
 
-    messages: list of {"role": "...", "content": "..."}
+    Returns the completion text, or with stream=True an iterator over the
+    text deltas as they arrive. response_format is passed through to the API
+    (e.g. {"type": "json_object"} for JSON mode, which cannot be streamed).
+
+    validate(text) -> bool is used by the cache layers only: a reply is cached
+    only if the caller's check accepts it, so unusable replies are fetched
+    again next time instead of being replayed.
+
+    Pass semantic=True to allow answers from the semantic cache for
+    near-duplicate prompts (only honoured for temperature <= 0.2).
+
+    messages: list of {"role": "...", "content": "..."}; content may also be a
+    list of text blocks (see cacheable_text). Blocks are sent as-is while the
+    API accepts them and flattened to plain strings otherwise.
     """
+    global _content_blocks_supported
+
+    if _has_content_blocks(messages):
+        if _content_blocks_supported:
+            try:
+                return _create(messages, model, temperature, stream, response_format)
+            except BadRequestError as e:
+                if not _is_content_shape_error(e):
+                    raise
+                logger.info("Content blocks rejected by the API; sending plain strings from now on")
+                _content_blocks_supported = False
+        messages = _flatten_content(messages)
+
+    return _create(messages, model, temperature, stream, response_format)
+
+
+def _is_retryable(e: BaseException) -> bool:
+    """
+    Same errors the Groq SDK retries by default: rate limits, dropped
+    connections/timeouts, 408, 409 and 5xx.
+    """
+    if isinstance(e, (RateLimitError, APIConnectionError)):
+        return True
+    return isinstance(e, APIStatusError) and (e.status_code in (408, 409) or e.status_code >= 500)
+
+
+def _log_retry(retry_state) -> None:
+    error = retry_state.outcome.exception()
+    logger.warning(
+        "%s: attempt %d failed (%s), retrying in %.1fs",
+        "429_retry" if isinstance(error, RateLimitError) else "transient_retry",
+        retry_state.attempt_number,
+        type(error).__name__,
+        retry_state.next_action.sleep,
+    )
+
+
+@retry(
+    retry=retry_if_exception(_is_retryable),
+    wait=wait_exponential_jitter(initial=1, max=30),
+    stop=stop_after_attempt(6),
+    before_sleep=_log_retry,
+    reraise=True,
+)
+def _create(messages, model: str, temperature: float, stream: bool, response_format: dict):
+    _rate_limiter.acquire()
+    logger.info("network_call: model=%s stream=%s", model, stream)
+    extra = {"response_format": response_format} if response_format else {}
     completion = client.chat.completions.create(
         model=model,
         messages=messages,
         temperature=temperature,
+        stream=stream,
+        **extra,
     )
+    if stream:
+        return _iter_deltas(completion)
     return completion.choices[0].message.content
+
+
+def _iter_deltas(completion):
+    for chunk in completion:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
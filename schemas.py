@@ -0,0 +1,158 @@
+from typing import Annotated, List, Literal, Union
+
+from pydantic import BaseModel, BeforeValidator, ConfigDict, Field
+
+NOT_SPECIFIED = "not_specified"
+
+
+# ---------------------------
+# Field types
+# ---------------------------
+
+def _number_or_zero(v):
+    """
+    Missing numeric values are 0 by convention; models often spell them
+    "not_specified" or null instead.
+    """
+    if v is None or (isinstance(v, str) and v.strip().lower() in ("", NOT_SPECIFIED, "n/a")):
+        return 0
+    return v
+
+
+def _text_or_not_specified(v):
+    if v is None or v == "":
+        return NOT_SPECIFIED
+    if isinstance(v, list):
+        return ", ".join(str(x) for x in v)
+    return v
+
+
+def _lower(v):
+    return v.strip().lower() if isinstance(v, str) else v
+
+
+def _dimensionality(v):
+    v = _text_or_not_specified(v)
+    return v.strip().upper() if isinstance(v, str) and v != NOT_SPECIFIED else v
+
+
+Number = Annotated[Union[int, float], BeforeValidator(_number_or_zero)]
+Text = Annotated[str, BeforeValidator(_text_or_not_specified)]
+YesNo = Annotated[Literal["yes", "no", "not_specified"], BeforeValidator(_lower)]
+Dimensionality = Annotated[
+    Literal["1D", "2D", "3D", "not_specified"], BeforeValidator(_dimensionality)
+]
+
+
+def _text(description: str):
+    return Field(default=NOT_SPECIFIED, description=description)
+
+
+def _yes_no():
+    return Field(default=NOT_SPECIFIED, description="yes|no|not_specified")
+
+
+# ---------------------------
+# Agent 2 – Article extraction schema
+# ---------------------------
+
+class ArticleInfo(BaseModel):
+    doi: Text = _text("Article DOI or not_specified")
+    title: Text = _text("Article title")
+    material_name: Text = _text("Name of the COF/MOF material (e.g., N3-COF, MOF-801)")
+
+
+class Reactants(BaseModel):
+    organic_linker_name: Text = _text("Chemical name of organic linker/ligand or not_specified")
+    organic_linker_quantity_mg: Number = 0
+    metal_node_name: Text = _text("Chemical name of metal core/node or not_specified")
+    metal_node_quantity_mg: Number = 0
+    solvent_name: Text = _text("Solvent name(s) or not_specified")
+    solvent_quantity_ml: Number = 0
+
+
+class SynthesisConditions(BaseModel):
+    reaction_time_seconds: Number = 0
+    reaction_temperature_celsius: Number = 0
+    stirring: YesNo = _yes_no()
+    total_reaction_time_seconds: Number = 0
+    stepwise_segmentation: Number = 0
+    ratio_components: Text = _text("Molar ratio (e.g., 1:1:2) or not_specified")
+    annealing_time_seconds: Number = 0
+    annealing_temperature_celsius: Number = 0
+
+
+class Morphology(BaseModel):
+    pore_size_nm: Number = 0
+    pore_width_nm: Number = 0
+    pore_distribution_nm: Text = _text("range in nm or not_specified")
+
+
+class ThermalProperties(BaseModel):
+    breakdown_temperature_celsius: Number = 0
+
+
+class SurfaceProperties(BaseModel):
+    surface_area_m2_per_g: Number = 0
+    functional_groups: Text = _text("List of functional groups or not_specified")
+
+
+class ChemicalProperties(BaseModel):
+    ph_range_min: Number = 0
+    ph_range_max: Number = 0
+
+
+class Structure(BaseModel):
+    nanocrystalline: YesNo = _yes_no()
+    amorphous: YesNo = _yes_no()
+    polar: YesNo = _yes_no()
+    nonpolar: YesNo = _yes_no()
+    dimensionality: Dimensionality = Field(
+        default=NOT_SPECIFIED, description="1D|2D|3D|not_specified"
+    )
+
+
+class Application(BaseModel):
+    application: Text = _text(
+        "Primary application or purpose (e.g., gas storage, catalysis, water harvesting)"
+    )
+
+
+class MaterialEntry(BaseModel):
+    article_info: ArticleInfo = Field(default_factory=ArticleInfo)
+    reactants: Reactants = Field(default_factory=Reactants)
+    synthesis_conditions: SynthesisConditions = Field(default_factory=SynthesisConditions)
+    morphology: Morphology = Field(default_factory=Morphology)
+    thermal_properties: ThermalProperties = Field(default_factory=ThermalProperties)
+    surface_properties: SurfaceProperties = Field(default_factory=SurfaceProperties)
+    chemical_properties: ChemicalProperties = Field(default_factory=ChemicalProperties)
+    structure: Structure = Field(default_factory=Structure)
+    application: Application = Field(default_factory=Application)
+
+
+class ArticleExtraction(BaseModel):
+    """
+    Top-level Agent 2 response. JSON mode only allows an object at the top
+    level, so the per-material list is wrapped under "materials". The wrapper
+    is strict: a missing or misspelled key fails validation (and triggers a
+    retry) instead of silently meaning "no materials".
+    """
+
+    model_config = ConfigDict(extra="forbid")
+
+    materials: List[MaterialEntry]
+
+
+def schema_skeleton(model) -> dict:
+    """
+    Render a model as the example object shown to the LLM: numeric fields as
+    0 and text fields as their description.
+    """
+    skeleton = {}
+    for name, field in model.model_fields.items():
+        annotation = field.annotation
+        if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+            skeleton[name] = schema_skeleton(annotation)
+        else:
+            skeleton[name] = field.description if field.description is not None else 0
+    return skeleton
@@ -0,0 +1,91 @@
+import os
+import sqlite3
+import threading
+
+import faiss
+import numpy as np
+from fastembed import TextEmbedding
+
+# Local ONNX MiniLM sentence embedder (384-dim).
+EMBED_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+
+class SemanticCache:
+    """
+    Reuse LLM responses for prompts that are near-duplicates of earlier ones.
+
+    Prompts are embedded with a local ONNX MiniLM model and searched in a FAISS
+    flat (exact cosine) index. Embeddings and raw responses are persisted in
+    SQLite, and the in-memory indexes are rebuilt from it on start-up.
+
+    Entries are grouped by namespace (model + system prompt) so a hit can only
+    return a response produced for the same kind of request.
+    """
+
+    def __init__(self, db_path: str, threshold: float = 0.92, model_name: str = EMBED_MODEL):
+        self.threshold = threshold
+        self._embedder = TextEmbedding(model_name=model_name)
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS entries (
+                id INTEGER PRIMARY KEY,
+                namespace TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                response TEXT NOT NULL
+            )
+            """
+        )
+        self._conn.commit()
+
+        # namespace -> (faiss index, row ids in insertion order)
+        self._indexes = {}
+        rows = self._conn.execute("SELECT id, namespace, embedding FROM entries ORDER BY id")
+        for row_id, namespace, blob in rows:
+            vec = np.frombuffer(blob, dtype=np.float32).reshape(1, -1)
+            self._add_to_index(namespace, row_id, vec)
+
+    def _embed(self, text: str) -> np.ndarray:
+        vec = np.asarray(next(iter(self._embedder.embed([text]))), dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        if norm > 0:
+            vec = vec / norm
+        return vec.reshape(1, -1)
+
+    def _add_to_index(self, namespace: str, row_id: int, vec: np.ndarray) -> None:
+        if namespace not in self._indexes:
+            self._indexes[namespace] = (faiss.IndexFlatIP(vec.shape[1]), [])
+        index, ids = self._indexes[namespace]
+        index.add(vec)
+        ids.append(row_id)
+
+    def get(self, namespace: str, text: str):
+        """
+        Return the stored response of the most similar prompt, or None if
+        nothing in the namespace reaches the similarity threshold.
+        """
+        vec = self._embed(text)
+        with self._lock:
+            if namespace not in self._indexes:
+                return None
+            index, ids = self._indexes[namespace]
+            scores, positions = index.search(vec, 1)
+            if positions[0][0] < 0 or scores[0][0] < self.threshold:
+                return None
+            row = self._conn.execute(
+                "SELECT response FROM entries WHERE id = ?", (ids[positions[0][0]],)
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, namespace: str, text: str, response: str) -> None:
+        vec = self._embed(text)
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT INTO entries (namespace, embedding, response) VALUES (?, ?, ?)",
+                (namespace, vec.tobytes(), response),
+            )
+            self._conn.commit()
+            self._add_to_index(namespace, cur.lastrowid, vec)